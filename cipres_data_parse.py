@@ -5,9 +5,10 @@ Program: cipres_data_parse
   to CIPRES gateway. Currently configued to handle BEAST, BEAST2, 
   MrBayes, GARLI configuration, and Migrate input files
 
-  Note that all files are opened with universal newlines support
-  ('rU') so that we can handle files created using the Linux, Windows
-  and Mac formats
+  Note that all files are opened in binary mode ('rb') and scanned as
+  bytes, skipping text decoding. Lines are split on '\n', '\r\n' and
+  '\r' alike, so that we can handle files created using the Linux,
+  Windows and Mac formats
 
   File parsing routines have very minimal error checking capabilities,
   definitely no substitute for a comprehensive file format checker
@@ -20,8 +21,42 @@ Program: cipres_data_parse
 
 import re
 import argparse
+import contextlib
+import mmap
 import os 
 
+# Regex used by the file parsing routines, compiled once at module level
+# rather than on every call
+
+# BEAST: one named alternative per line type of interest (dataType,
+# npatterns and codon lines, plus the start of the <mcmc> element),
+# each match is dispatched on lastgroup.
+# The dataType value is captured up to the closing quote, blanks and all
+# (e.g. "amino acid"), and its whitespace is removed in process_beast.
+# Every match is kept within one line, whichever of '\n', '\r\n' or
+# '\r' ends it, by using [^\r\n] rather than '.' and only blanks and
+# tabs around '='
+_RE_BEAST = re.compile(rb'(?P<dt>alignment[^\r\n]*?data[tT]ype[ \t]*=[ \t]*"(?P<datatype>[^"\r\n]*)")'
+                       rb'|(?P<np>npatterns[ \t]*=[ \t]*(?P<npatterns>\d+))'
+                       rb'|(?P<cd>codon)'
+                       rb'|(?P<mc><mcmc\b)')
+
+# GARLI: a single pattern covers all three keywords, the matched keyword
+# is in 'kind'. Only blanks and tabs are allowed around '=', so the value
+# must be on the same line as its keyword
+_RE_GARLI = re.compile(rb'(?P<kind>bootstrapreps|searchreps|availablememory)'
+                       rb'[ \t]*=[ \t]*(?P<value>\d+)')
+
+# MrBayes: a single pattern locates the mcmc/mcmcp line and collects
+# nruns and nchains from it. Each value is in an optional lookahead, so
+# it is captured wherever it appears on the line, in either order, and
+# the group is None if it's missing. The line may start after a '\n' or
+# a Mac '\r', and [^\r\n] is used rather than '.' so that neither value
+# can be taken from a later line
+_RE_BAYES = re.compile(rb'(?:^|(?<=\r))[ \t]*mcmcp?[ \t]'
+                       rb'(?=(?:[^\r\n]*?nruns[ \t]*=[ \t]*(?P<nruns>\d+))?)'
+                       rb'(?=(?:[^\r\n]*?nchains[ \t]*=[ \t]*(?P<nchains>\d+))?)', re.M)
+
 # Process the command line arguments
 file_types = ['beast', 'beast2', 'migrate_parm', 'migrate_infile', 'bayes', 'garli']
 parser     = argparse.ArgumentParser(description='Process file name and file type cmd line args')
@@ -31,6 +66,19 @@ args      = parser.parse_args()
 file_name = args.file_name
 file_type = args.file_type
 
+@contextlib.contextmanager
+def mapped_file(file_name):
+    ''' Open file_name read-only and yield its contents as a memory map,
+        so that the regex can be run over the whole buffer at once.
+        Empty files yield an empty bytes object since they can't be mapped
+    '''
+    with open(file_name, 'rb') as fin:
+        if os.fstat(fin.fileno()).st_size == 0:
+            yield b''
+        else:
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                yield buf
+
 def process_beast(file_name):
     ''' Process BEAST files and return following
     
@@ -49,40 +97,33 @@ def process_beast(file_name):
     # Start by assuming successful parsing of file
     err_code = 0
 
-    # Define the regex that will be used to identify
-    # and parse the dataType, npatterns and codon lines
-    regex_datatype = '.*alignment.*data[tT]ype\s*=\s*"'
-    regex_patterns = '.*npatterns\s*=\s*'
-    regex_codon    = 'codon'
-
-    # Compile the regex. Probably doesn't make a performance difference
-    # since python will cache recently used regex, but doesn't hurt
-    cregex_datatype = re.compile('.*alignment.*data[tT]ype\s*=\s*"')
-    cregex_patterns = re.compile('.*npatterns\s*=\s*')
-    cregex_codon    = re.compile('codon')
-
-    with open(file_name, 'rU') as fin:
-        for line in fin:
-            line = line.rstrip()
+    # Run the regex over the whole mapped file rather than line by line
+    with mapped_file(file_name) as buf:
+        for match in _RE_BEAST.finditer(buf):
+            kind = match.lastgroup
 
             # Process the dataType lines
-            if cregex_datatype.search(line):
-                line = re.sub(regex_datatype, '', line)
-                line = re.sub('".*', '', line)
-                datatype = re.sub('\s*', '', line)
+            # All whitespace is removed from the value, so that BEAUti's
+            # "amino acid" becomes aminoacid
+            if kind == 'dt':
+                datatype = b''.join(match.group('datatype').split()).decode()
 
             # Process the lines that list number of patterns
             # Increment pattern and partition counts
-            if cregex_patterns.search(line):
-                line = re.sub(regex_patterns, '', line)
-                line = re.sub('\D.*', '', line)
-                pattern_count += int(line)
+            elif kind == 'np':
+                pattern_count += int(match.group('npatterns'))
                 nu_partitions += 1
-                    
+
             # Look for lines that contain the string "codon"
-            if cregex_codon.search(line):
+            elif kind == 'cd':
                 codon_partitioning = True
 
+            # The alignments, patterns and models are all defined before
+            # the <mcmc> element, which only refers back to them, so stop
+            # scanning here once the data type has been seen
+            elif datatype != 'unknown':
+                break
+
     # Test for errors:
     # Data type is not set to aminoacid or nucleotide
     if datatype != 'aminoacid' and datatype != 'nucleotide':
@@ -110,17 +151,17 @@ def process_beast2(file_name):
     # Start by assuming successful parsing of file
     err_code = 0
 
-    with open(file_name, 'rU') as fin:
-        for line in fin:
-            line = line.rstrip()
-            
+    # Split with splitlines rather than iterating over the binary file,
+    # which only splits on '\n', so Mac ('\r') line endings are handled
+    with open(file_name, 'rb') as fin:
+        for line in fin.read().splitlines():
             # Look for the starting line
-            if line.find('<distribution id="likelihood"') >= 0:
+            if b'<distribution id="likelihood"' in line:
                 start_counting = True
                 continue
                 
             # Start counting partitions
-            if start_counting and line.find('<distribution') >= 0 and line.find('/>') < 0:
+            if start_counting and b'<distribution' in line and b'/>' not in line:
                 nu_partitions += 1
 
     # Test for errors:
@@ -145,13 +186,11 @@ def process_migrate_parm(file_name):
     # Start by assuming successful parsing of file
     err_code = 0
 
-    with open(file_name, 'rU') as fin:
-        for line in fin:
-            line = line.rstrip()
-            
+    with open(file_name, 'rb') as fin:
+        for line in fin.read().splitlines():
             # Look for the starting line
-            if line.find('replicate=YES') >= 0:
-                p1, num_reps = line.split(':')
+            if b'replicate=YES' in line:
+                p1, num_reps = line.rstrip().decode().split(':')
                 break
 
     # Test for errors:
@@ -175,11 +214,12 @@ def process_migrate_infile(file_name):
     # Start by assuming successful parsing of file
     err_code = 0
 
-    with open(file_name, 'rU') as fin:
+    # Iterating over the binary file only splits on '\n', so the first
+    # record is cut at any other line ending as well
+    with open(file_name, 'rb') as fin:
         for line in fin:
-            line = line.strip()
-            pline = line.split()
-            num_loci = pline[1]
+            pline = line.splitlines()[0].split()
+            num_loci = pline[1].decode()
             break
 
     # Test for errors:
@@ -207,47 +247,27 @@ def process_garli(file_name):
     # Start by assuming successful parsing of file
     err_code = 0
 
-    # define, compile regex for extracting desired values 
-    cregex_bootstrapreps = re.compile('bootstrapreps\s*=\s*(\d+).*')
-    cregex_searchreps = re.compile('searchreps\s*=\s*(\d+).*')
-    cregex_availmem = re.compile('.*availablememory\s*=\s*(\d+).*')
-
     # start with negative parameter values 
     nruns = -1
     bootreps = -1
     searchreps = -1
     availmem = -1
-    have_bootreps = False
-    have_searchreps = False
-    have_availmem = False
 
-    with open(file_name, 'rU') as fin:
-        for line in fin:
-            line = line.strip()
-
-            # see if line has bootstrapreps value
-            # if it does, collect value
-            if not have_bootreps: 
-                match = cregex_bootstrapreps.search(line)
-                if match: 
-                    bootreps = match.group(1)
-                    have_bootreps = True
-
-            # see if line has searchreps value
-            # if it does, collect value
-            if not have_searchreps: 
-                match = cregex_searchreps.search(line)
-                if match: 
-                    searchreps = match.group(1)
-                    have_searchreps = True
-
-            # see if line has availablememory value
-            # if it does, collect value
-            if not have_availmem:
-                match = cregex_availmem.search(line)
-                if match:
-                    availmem = match.group(1)
-                    have_availmem = True
+    # collect the first value seen for each keyword, stop scanning
+    # once all three have been found
+    values = {}
+    with mapped_file(file_name) as buf:
+        for match in _RE_GARLI.finditer(buf):
+            values.setdefault(match.group('kind'), match.group('value').decode())
+            if len(values) == 3:
+                break
+
+    have_bootreps = b'bootstrapreps' in values
+    have_searchreps = b'searchreps' in values
+    have_availmem = b'availablememory' in values
+    bootreps = values.get(b'bootstrapreps', bootreps)
+    searchreps = values.get(b'searchreps', searchreps)
+    availmem = values.get(b'availablememory', availmem)
 
     # Test for errors:
     if not have_bootreps or not have_searchreps or not have_availmem:
@@ -279,12 +299,6 @@ def process_bayes(file_name):
     # Start by assuming successful parsing of file
     err_code = 0
 
-    # Define, compile regex to collect nruns and nchains values
-    cregex_mcmcp = re.compile('^(mcmc|mcmcp)\s')
-    cregex_nruns = re.compile('.*nruns\s*=\s*(\d+).*')
-    cregex_nchains = re.compile('.*nchains\s*=\s*(\d+).*')
-
-    cregex_bootstrapreps = re.compile('bootstrapreps\s*=\s*(\d+).*')
     # start with no runs/chains
     nruns = -1
     nchains = -1
@@ -292,30 +306,18 @@ def process_bayes(file_name):
 
     # First check for a line headed by 'mcmc' or 'mcmcp'. If present, collect
     # nruns and nchains values, otherwise exit
-    with open(file_name, 'rU') as fin:
-        for line in fin:
-            line = line.strip()
-
-            # First check for "begin mrbayes;" line
-            if cregex_mcmcp.search(line):
-                mrbayes = True
-
-                # Search for nruns, collect value
-                # otherwise, use default value
-                match = cregex_nruns.search(line)
-                if match:
-                    nruns = match.group(1)
-                else:
-                    nruns = 2
-
-                # Search for nchains, collect value
-                # otherwise, use default value
-                match = cregex_nchains.search(line)
-                if match: 
-                    nchains = match.group(1)
-                else:
-                    nchains = 4
-                break
+    with mapped_file(file_name) as buf:
+        match = _RE_BAYES.search(buf)
+        if match:
+            mrbayes = True
+
+            # Collect nruns and nchains values
+            # otherwise, use default values
+            nruns = match.group('nruns')
+            nruns = nruns.decode() if nruns else 2
+
+            nchains = match.group('nchains')
+            nchains = nchains.decode() if nchains else 4
 
     # Test for errors:
     # Number of partitions non-positive number
@@ -327,82 +329,56 @@ def process_bayes(file_name):
 
     return err_code, nruns, nchains
 
+# Parsing routine for each file type, with the names of the values it
+# returns in the order they're returned
+parsers = {
+    'beast':          (process_beast,          ['err_code', 'datatype', 'codon_partitioning',
+                                                'nu_partitions', 'pattern_count']),
+    'beast2':         (process_beast2,         ['err_code', 'nu_partitions']),
+    'migrate_parm':   (process_migrate_parm,   ['err_code', 'num_reps']),
+    'migrate_infile': (process_migrate_infile, ['err_code', 'num_loci']),
+    'garli':          (process_garli,          ['err_code', 'nruns', 'bootstrapreps',
+                                                'searchreps', 'availablememory']),
+    'bayes':          (process_bayes,          ['err_code', 'nruns', 'nchains']),
+}
+
+def format_results(file_type, names, values):
+    ''' Format the values returned by a parsing routine as name=value
+        lines, headed by the file type
+    '''
+    lines = ['file_type=' + file_type]
+    lines += [name + '=' + str(value) for name, value in zip(names, values)]
+
+    return '\n'.join(lines)
+
 #--------------------------------------------------------------
 # ------------------- Start main program ----------------------
 #--------------------------------------------------------------
 
-# Determine the input file type if not already set
+# Determine the input file type if not already set. The identifying
+# markers all appear in the file header, so only the first 16KB are read
+# and each marker is looked for in that block with a single substring test
 if file_type == 'unknown':
-    with open(file_name, 'rU') as fin:
-        for line in fin:
-            if line.find('BEAUTi') >= 0:
-                file_type = 'beast'
-                break
-            if line.find('<beast') >= 0 and line.find('version="2.0">') >= 0:
-                file_type = 'beast2'
-                break
-            if line.find('Parmfile for Migrate') >= 0:
-                file_type = 'migrate_parm'
-                break
-            if line.find('#NEXUS') >= 0:
-                file_type = 'bayes'
-                break
-            if line.find('[general]') >= 0:
-                file_type = 'garli'
-                break
-
-# Process BEAST files
-if file_type == 'beast':
-    err_code, datatype, codon_partitioning, nu_partitions, pattern_count = process_beast(file_name)
-    results =  'file_type=' + file_type + '\n'
-    results += 'err_code=' + str(err_code) + '\n'
-    results += 'datatype=' + datatype + '\n'
-    results += 'codon_partitioning=' + str(codon_partitioning) + '\n'
-    results += 'nu_partitions=' + str(nu_partitions) +'\n'
-    results += 'pattern_count=' + str(pattern_count)
-
-# Process BEAST2 files
-if file_type == 'beast2':
-    err_code, nu_partitions = process_beast2(file_name)
-    results =  'file_type=' + file_type + '\n'
-    results += 'err_code=' + str(err_code) + '\n'
-    results += 'nu_partitions=' + str(nu_partitions)
-
-# Process Migrate parmfile
-if file_type == 'migrate_parm':
-    err_code, num_reps = process_migrate_parm(file_name)
-    results =  'file_type=' + file_type + '\n'
-    results += 'err_code=' + str(err_code) + '\n'
-    results += 'num_reps=' + str(num_reps)
-
-# Process Migrate infile
-if file_type == 'migrate_infile':
-    err_code, num_loci = process_migrate_infile(file_name)
-    results =  'file_type=' + file_type + '\n'
-    results += 'err_code=' + str(err_code) + '\n'
-    results += 'num_loci=' + str(num_loci)
-
-# Process GARLI configuration infile 
-if file_type == 'garli':
-    err_code, nruns, bootreps, searchreps, availmem = process_garli(file_name)
-    results = 'file_type=' + file_type + '\n'
-    results += 'err_code=' + str(err_code) + '\n'
-    results += 'nruns=' + str(nruns) + '\n'
-    results += 'bootstrapreps=' + str(bootreps) + '\n'
-    results += 'searchreps=' + str(searchreps) + '\n'
-    results += 'availablememory=' + str(availmem)
-
-# Process MrBayes files
-if file_type == 'bayes':
-    err_code, nruns, nchains = process_bayes(file_name)
-    results = 'file_type=' + file_type + '\n'
-    results += 'err_code=' + str(err_code) + '\n'
-    results += 'nruns=' + str(nruns) + '\n'
-    results += 'nchains=' + str(nchains)
+    with open(file_name, 'rb') as fin:
+        head = fin.read(16384)
+    if b'BEAUTi' in head:
+        file_type = 'beast'
+    elif b'<beast' in head and b'version="2.0">' in head:
+        file_type = 'beast2'
+    elif b'Parmfile for Migrate' in head:
+        file_type = 'migrate_parm'
+    elif b'#NEXUS' in head:
+        file_type = 'bayes'
+    elif b'[general]' in head:
+        file_type = 'garli'
+
+# Process the file with the parsing routine for its type
+if file_type in parsers:
+    process, names = parsers[file_type]
+    results = format_results(file_type, names, process(file_name))
 
 # Unknown or unidentifiable file type
-if file_type == 'unknown':
-    results =  'file_type=' + file_type + '\n'
-    results += 'err_code=1'
+else:
+    results = format_results(file_type, ['err_code'], [1])
 
 print(results)
@@ -11,104 +11,164 @@ Execute this file inside the directory containing all of your .best.tre files
 
 Simply run as:
 > python3 post_garli.py
+
+or, to rank only the K highest scoring trees:
+> python3 post_garli.py --top K
 '''
 
+import argparse
+import heapq
+import math
+import mmap
 import os 
-import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# token preceding the score in a .best.tre file, e.g. [!GarliScore -1234.56]
+score_token = b'GarliScore'
+
+# the only characters allowed in a score, besides surrounding whitespace
+score_chars = b'+-.0123456789eE'
+
+# size of the block read from the start of each file, the score is
+# usually found within it
+page_size = 4096
+
+# buffer for that block, one per worker thread and reused across files
+page = threading.local()
 
-def collect_score(regex_score, line):
+def collect_score(buf, pos, size=None):
     '''
-    Collects the GarliScore from current line using regex
-    Parameters: regex_score - compiled regex for pulling score from line
-                line - line to collect score from
+    Collects the GarliScore following the score token
+    Parameters: buf - file contents (bytes, bytearray or mmap) to collect score from
+                pos - offset of the score token in buf
+                size - number of valid bytes in buf, defaults to len(buf)
     Returns: The collected GarliScore, or score of 0 if none is found
     '''
-    match = regex_score.search(line)
+    if size is None:
+        size = len(buf)
 
-    # if a score is collected, store value
-    if match:
-        score = float(match.group(1))
+    # the score runs from the end of the token to the closing bracket of
+    # the comment, which must be on the same line
+    start = pos + len(score_token)
+    eol = buf.find(b'\n', start, size)
+    end = buf.find(b']', start, eol if eol >= 0 else size)
 
+    # if a score is collected, store value
     # otherwise give error score of 0
-    else:
-        score = 0
+    # float() also accepts nan, inf and digit separators, so anything but
+    # a plain finite number is rejected first
+    score = 0
+    if end >= 0:
+        value = bytes(buf[start:end]).strip()
+        if not value.translate(None, score_chars):
+            try:
+                score = float(value)
+            except ValueError:
+                pass
+            if not math.isfinite(score):
+                score = 0
 
     return score
+
+def score_of(filename):
+    '''
+    Collects the GarliScore from a single .best.tre file
+    Parameters: filename - name of the .best.tre file
+    Returns: (filename, score) pair, score is None if none is found
+    '''
+    if not hasattr(page, 'buf'):
+        page.buf = bytearray(page_size)
+
+    score = 0
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        # read the first block of the file into the reused buffer and
+        # look for the score token there
+        nbytes = os.preadv(fd, [page.buf], 0)
+        pos = page.buf.find(score_token, 0, nbytes)
+        if pos >= 0:
+            score = collect_score(page.buf, pos, nbytes)
+
+        # if the score wasn't complete within the first block and the file
+        # is longer, map the whole file and jump straight to the token
+        if score == 0 and nbytes == page_size:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                pos = mm.find(score_token)
+                if pos >= 0:
+                    score = collect_score(mm, pos)
+    finally:
+        os.close(fd)
+
+    return filename, score or None
  
-def make_out_file(score_dict):
+def make_out_file(scores, names, top=None):
     '''
     Creates the output file containing scores and their corresponding 
        filenames in descending order
-    Parameters: score_dict - dictionary of scores, filenames
+    Parameters: scores - list of scores
+                names - list of filenames, names[i] is the file scores[i] came from
+                top - number of highest scores to write, all scores if None
     Returns: nothing
     '''
-    output_file = open('garli_scores.txt', 'w')
-    output_file.write('### RANK OF GARLI SCORES (highest to lowest) ###\n\n Score:\tfilename \n')
+    # sort scores in descending order, when only the top few are wanted
+    # pick them out with a heap rather than sorting the full list
+    # files with equal scores are all kept, in the order they were collected
+    if top is None:
+        order = sorted(range(len(scores)), key=scores.__getitem__, reverse = True)
+    else:
+        order = heapq.nlargest(top, range(len(scores)), key=scores.__getitem__)
 
-    # sort scores in descending order, write to output file
-    for gs in sorted(score_dict, reverse = True):
-        output_file.write('%s: %s \n' % (gs, score_dict[gs]))  
-        
-    output_file.close
+    # write to output file, through a large buffer so the lines go out
+    # in as few writes as possible
+    with open('garli_scores.txt', 'w', buffering=1 << 20) as output_file:
+        output_file.write('### RANK OF GARLI SCORES (highest to lowest) ###\n\n Score:\tfilename \n')
+        output_file.writelines('%s: %s \n' % (scores[i], names[i]) for i in order)
 
 
 ''' Main ''' 
 
-print('\n############### Ranking Garli Scores ############### \n')
+# Process the command line arguments
+parser = argparse.ArgumentParser(description='Rank the Garli scores of the .best.tre files in the current directory')
+parser.add_argument('--top', dest='top', type=int, default=None, metavar='K',
+                    help='only rank the K highest scores')
+args = parser.parse_args()
 
-# create empty dictionary to store filename, score pairs
-score_dict = {}
+# K of 0 or less would leave an empty ranking
+if args.top is not None and args.top < 1:
+    parser.error('--top K must be a positive integer')
+
+print('\n############### Ranking Garli Scores ############### \n')
 
-# regex to pull GarliScore (compiled)
-regex_score = re.compile('GarliScore\s([-?]\d+[\.\d]+)')
+# create empty parallel lists to store scores and their filenames,
+# two files may have the same score so the score can't be used as a key
+scores = []
+names = []
 
 # start with no error and empty list of error-prone Garli output files
 error_code = 0
 problem_files= []
 
-first_file = True
-lines_until_score = 0
-
 # loop through all *.best.tre files in current directory
 print('Processing files... \n')
 
-files = [f for f in os.listdir('.') if f.endswith('.best.tre')] 
-
-for filename in files:
-    with open(filename, 'rU') as fin: 
-        line_num = 0
-        for line in fin:
-
-            # for the first file, count the number of lines before reaching the 
-            # line containing Garli score. Once reached, stop counting lines and
-            # store score
-            if first_file:
-                line = line.rstrip()
-                if line.find('GarliScore') >= 0:
-                    score = collect_score(regex_score, line)
-                    first_file = False
-                    break
-
-                lines_until_score += 1
-            
-            # for all other files, jump to line with score and collect score
-            else:
-                if line_num == lines_until_score:
-                    line = line.rstrip()
-                    score = collect_score(regex_score, line)
-                    break
-                else:
-                    line_num += 1
-
-    # give files for which score retrieval was unsuccessful an error code of 1, 
-    # add their name to list of problematic files
-    if score == 0:
-        error_code = 1
-        problem_files.append(filename)
-    
-    # otherwise, add score, filename to list of scores 
-    else:
-        score_dict[score] = filename
+files = [e.name for e in os.scandir('.') if e.is_file() and e.name.endswith('.best.tre')]
+
+# files are independent and the work is mostly waiting on I/O, so
+# collect the scores in a thread pool
+with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+    for filename, score in executor.map(score_of, files):
+
+        # give files for which score retrieval was unsuccessful an error code of 1, 
+        # add their name to list of problematic files
+        if score is None:
+            error_code = 1
+            problem_files.append(filename)
+
+        # otherwise, add score, filename to lists of scores, filenames
+        else:
+            scores.append(score)
+            names.append(filename)
 
 # print error_code and problem_files (if relevant)
 if error_code == 1:
@@ -118,7 +178,7 @@ if error_code == 1:
 
 else:
     # add scores with corresponding filename to file called garli_scores.txt
-    make_out_file(score_dict)
+    make_out_file(scores, names, args.top)
 
     print('All scores were collected successfully, please see\n'
            + 'garli_scores.txt for ranked Garli scores.\n')